@@ -6,6 +6,11 @@ import time
 import re
 import os
 import urllib
+import urllib2
+import httplib
+import cPickle
+from hashlib import md5
+from multiprocessing import Pool
 from feedparser import parse
 from re import search, match
 from datetime import datetime
@@ -19,11 +24,14 @@ OLD_URLS = set()    # urls of old episodes
 OLD_GUIDS = set()   # guids of old episodes
 NEW_URLS = set()    # urls of episodes that need to be comitted to file
 NEW_GUIDS = set()   # urls of episodes that need to be comitted to file
+ALL_FEEDS = set()   # every feedurl in the podcasts file, skipped or not
+FEED_CACHE = dict() # per-feed caches that need to be comitted to file
 
 DEFAULT_CONFIG = { \
                     'f_oldshows': '~/.redrain/oldshows', \
                     'f_podcasts': '~/.redrain/podcasts', \
                     'd_download_dir': '~/.redrain/download/', \
+                    'd_feedcache': '~/.redrain/feedcache/', \
                     'f_lastrun': '~/.redrain/lastrun'}
 
 LASTRUN = datetime(2013, 8, 24, 0, 0)
@@ -188,6 +196,8 @@ def load_podcasts():
         rex = match(r'(.+?)=(.+)', line)
         if rex is not None:
             show[rex.group(1)] = rex.group(2)
+            if rex.group(1) == 'feedurl':
+                ALL_FEEDS.add(rex.group(2))
             continue
 
         # match a comment
@@ -226,43 +236,314 @@ def scrape_feed_url(url, nicename='NoneProvided'):
     returned to the end user.  Six keys are in each 'episode' :
     'url', 'title', 'guid', 'date', 'showname', and 'nicename'.
     """
-    showlist = []
-    fp_data = parse(url)
+    error, episodes = parse_feed(url)
 
     # This warning is badly placed; shouldn't print to console in redrain.py
-    if fp_data.bozo == 1:
+    if error is not None:
         print '[error]',
 
+    return [episode_dict(x, nicename) for x in episodes]
+
+
+def fetch_feed(url):
+    """Downloads a given URL and returns the raw feed.
+
+    Arguments - a url (or even a file) that points to a XML feed.
+
+    This is the "fetch" half of scrape_feeds; nothing is parsed here.  Returns
+    a tuple of (data, headers, error) where headers are the HTTP response
+    headers, so that both can be handed to parse_feed, possibly in another
+    process.  If the feed can't be read (including HTTP errors), data is an
+    empty string and error says why; otherwise error is None.
+    """
+    try:
+        if os.path.exists(url):
+            f_feed = open(url, 'rb')
+            headers = dict()
+        else:
+            request = urllib2.Request(url, \
+                headers={'User-Agent': RRopener.version})
+            f_feed = urllib2.urlopen(request)
+            headers = dict(f_feed.info())
+            # feedparser can't see the url of raw data; keep relative links
+            headers.setdefault('content-location', f_feed.geturl())
+        data = f_feed.read()
+        f_feed.close()
+    # urllib2 raises ValueError for feedurls that aren't urls or files
+    except (IOError, ValueError, urllib2.URLError, httplib.HTTPException), exc:
+        return ('', dict(), error_message(exc))
+
+    return (data, headers, None)
+
+
+def parse_feed(data, headers=None):
+    """Parses a feed and returns a compact list of its episodes.
+
+    Arguments - raw feed data, or a url/file that feedparser can read.
+    Optionally, the HTTP response headers that came with the data.
+
+    Returns a tuple of (error, episodes) where error is None, or a message
+    if feedparser flagged the feed as bozo, and episodes is a list of tuples
+    in the form (title, guid, url, date, showname).  Entries that lack an
+    enclosure are dropped.  This is kept to plain tuples so that it's cheap
+    to send back from a worker process.
+    """
+    episodes = []
+    fp_data = parse(data, response_headers=headers)
+
     # iterate over the entries within the feed
     for entry in fp_data.entries:
-        tmp = dict()
-        tmp['title'] = entry.title
-        tmp['guid'] = entry.guid
-        tmp['showname'] = fp_data.feed.title
-        tmp['nicename'] = nicename
+        # within each entry is a list of enclosures (hopefully of length 1)
+        url = None
+        for enclosure in entry.enclosures:
+            url = enclosure['href']
+
+        # temp hack, but this skips enclosures that lack certain attributes.
+        if url is None:
+            continue
 
-        # prep updated_parsed for conversion datetime object
+        # prep published_parsed for conversion datetime object
         dnt = list(entry.published_parsed[0:5])
 
-        tmp['date'] = datetime(dnt[0], dnt[1], dnt[2], dnt[3], dnt[4])
+        episodes.append((entry.title, entry.guid, url, \
+            datetime(dnt[0], dnt[1], dnt[2], dnt[3], dnt[4]), \
+            fp_data.feed.title))
 
-        # within each entry is a list of enclosures (hopefully of length 1)
-        for enclosure in entry.enclosures:
-            tmp['url'] = enclosure['href']
+    error = None
+    if fp_data.bozo == 1:
+        error = error_message(fp_data.get('bozo_exception', 'bozo feed'))
 
-        # temp hack, but this fixes enclosures that lack certain attributes.
-        if valid_item(tmp) == True:
-            showlist.append(tmp)
+    return (error, episodes)
 
-    return showlist
 
+def parse_fetched(fetched):
+    """Support function for scrape_feeds; unpacks fetch_feed's result."""
+    # nothing to parse if the fetch failed
+    if fetched[2] is not None:
+        return (fetched[2], [])
 
-def valid_item(item):
-    """Debug function: test to see if an item is up to spec."""
-    for key in ['title', 'guid', 'showname', 'nicename', 'date', 'url']:
-        if item.get(key, 'FAIL') == 'FAIL':
-            return False
-    return True
+    return parse_feed(fetched[0], fetched[1])
+
+
+def error_message(exc):
+    """Support function: turns an exception into a printable string."""
+    try:
+        return str(exc)
+    except UnicodeError:
+        return repr(exc)
+
+
+def episode_dict(episode, nicename='NoneProvided'):
+    """Expands an episode tuple from parse_feed into a dictionary.
+
+    Arguments - a tuple of (title, guid, url, date, showname) and optionally
+    the 'nicename' of the show.
+
+    The dictionary has the same six keys that scrape_feed_url provides.
+    """
+    return {'title': episode[0], 'guid': episode[1], 'url': episode[2], \
+        'date': episode[3], 'showname': episode[4], 'nicename': nicename}
+
+
+def scrape_feeds(podcasts):
+    """Downloads and parses every feed in a list of podcasts.
+
+    Arguments - a list of podcast dictionaries, each with a 'feedurl' key.
+
+    All of the feeds are fetched first, then the raw data is parsed.  If
+    CONFIG['parse_procs'] is greater than 1, parsing is done by a pool of that
+    many processes, since feedparser is pure python and won't use more than
+    one core otherwise.  Feeds that are byte-for-byte the same as last time
+    aren't parsed at all.
+
+    Returns a list of (error, count, episodes) tuples in the same order as
+    podcasts.  error is None or a message saying what went wrong with the
+    feed, count is the number of episodes in the feed and episodes holds
+    only the ones that are new or changed since the last run (see
+    diff_feed).
+    """
+    raw = [fetch_feed(show['feedurl']) for show in podcasts]
+    digests = [md5(fetched[0]).hexdigest() for fetched in raw]
+    caches = [load_feed_cache(show['feedurl']) for show in podcasts]
+
+    # only parse the feeds that have changed
+    todo = [k for k in xrange(len(raw)) if digests[k] != caches[k][0]]
+
+    # parse_procs comes straight from the config; don't trust it
+    try:
+        procs = int(CONFIG.get('parse_procs', '1'))
+    except ValueError:
+        procs = 0
+    if procs < 1:
+        print 'Error: parse_procs should be a number above 0, using 1.'
+        procs = 1
+
+    if procs > 1 and len(todo) > 1:
+        pool = Pool(min(procs, len(todo)))
+        try:
+            # map_async + get with a timeout so ctrl-c isn't swallowed
+            parsed = pool.map_async(parse_fetched, \
+                [raw[k] for k in todo], 1).get(60 * 60 * 24 * 7)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        parsed = [parse_fetched(raw[k]) for k in todo]
+
+    # unchanged feeds keep their cached error and episode list
+    results = [(cache[1], cache[2]) for cache in caches]
+    for k, result in zip(todo, parsed):
+        results[k] = result
+
+    # diff against the caches; this also queues up the new caches
+    feeds = list()
+    for k in xrange(len(podcasts)):
+        error, episodes = results[k]
+        fresh = diff_feed(podcasts[k]['feedurl'], digests[k], error, \
+            episodes, caches[k][2])
+        feeds.append((error, len(episodes), fresh))
+
+    return feeds
+
+
+def feed_cache_dir():
+    """Returns the cache directory for the current configuration.
+
+    Arguments -- None.
+
+    Each combination of podcasts, oldshows and lastrun files gets its own
+    subdirectory of CONFIG['d_feedcache'], named after the md5 of their
+    paths.  A cache only says which episodes were already checked against
+    a particular oldshows and lastrun, so separate configs sharing one
+    d_feedcache can't use (or evict) each other's caches.
+    """
+    paths = '\n'.join([fixpath(CONFIG.get(key, DEFAULT_CONFIG[key])) \
+        for key in ['f_podcasts', 'f_oldshows', 'f_lastrun']])
+
+    return os.path.join(fixpath(CONFIG.get('d_feedcache', \
+        DEFAULT_CONFIG['d_feedcache'])), md5(paths).hexdigest())
+
+
+def feed_cache_path(feedurl):
+    """Returns the path of the cache file for a given feed.
+
+    Arguments - a feedurl.
+
+    Cache files live in feed_cache_dir() and are named after the md5 of the
+    feedurl, with a '.cache' extension.
+    """
+    return os.path.join(feed_cache_dir(), md5(feedurl).hexdigest() + '.cache')
+
+
+def load_feed_cache(feedurl):
+    """Loads the cached episode list for a feed.
+
+    Arguments - a feedurl.
+
+    Returns a tuple of (digest, error, episodes) where digest is the md5 of
+    the raw feed the last time it was seen, error is the error parse_feed
+    gave for it (or None) and episodes is the list of episode tuples parsed
+    from it.  If there's no usable cache, (None, None, []) is returned.  That
+    includes a cache that was saved against a later lastrun or a bigger
+    oldshows than the ones loaded now (see filter_state), since its
+    episodes might not be old any more.
+    """
+    path = feed_cache_path(feedurl)
+
+    if os.path.exists(path) == False:
+        return (None, None, [])
+
+    f_cache = open(path, 'rb')
+    try:
+        cache = cPickle.load(f_cache)
+    except Exception:
+        cache = None
+    f_cache.close()
+
+    # anything that isn't shaped like a cache is treated as no cache at all
+    if not isinstance(cache, tuple) or len(cache) != 4 \
+        or not isinstance(cache[2], list) \
+        or not isinstance(cache[3], tuple) or len(cache[3]) != 3:
+        return (None, None, [])
+    for episode in cache[2]:
+        if not isinstance(episode, tuple) or len(episode) != 5:
+            return (None, None, [])
+
+    # lastrun went backwards or oldshows lost entries; check everything
+    for then, now in zip(cache[3], filter_state()):
+        if then > now:
+            return (None, None, [])
+
+    return cache[0:3]
+
+
+def filter_state():
+    """Support function: describes what filter_list checks episodes against.
+
+    Returns a tuple of (LASTRUN, number of old urls, number of old guids).
+    Normally all three only ever go up between runs.
+    """
+    return (LASTRUN, len(OLD_URLS), len(OLD_GUIDS))
+
+
+def diff_feed(feedurl, digest, error, episodes, cached):
+    """Finds the episodes in a feed that are new or changed.
+
+    Arguments - a feedurl, the md5 of the raw feed, the error and the list of
+    episode tuples from parse_feed and the cached list of episode tuples from
+    load_feed_cache.
+
+    Episodes are matched up by guid; any episode that wasn't cached or that
+    differs from the cached copy is returned.  The new list is put into
+    FEED_CACHE to be written out by save_feed_cache, unless the feed came
+    back empty (usually because it couldn't be fetched).
+    """
+    old = dict((x[1], x) for x in cached)
+
+    if len(episodes) > 0:
+        FEED_CACHE[feedurl] = (digest, error, episodes)
+
+    return [x for x in episodes if old.get(x[1]) != x]
+
+
+def save_feed_cache():
+    """Writes the feed caches to disk and removes stale ones.
+
+    Arguments -- None.
+
+    Dumps everything in FEED_CACHE to its cache file, then deletes the cache
+    files of any feeds that are no longer in the podcasts file.  Anything in
+    the directory that isn't a cache file is left alone.  This should
+    only be called once the episodes have been dealt with, otherwise they'll
+    be skipped over on the next run.
+    """
+    global FEED_CACHE
+
+    path = feed_cache_dir()
+    if os.path.exists(path) == False:
+        os.makedirs(path)
+
+    # save the caches, along with what they were checked against
+    state = filter_state()
+    for feedurl, cache in FEED_CACHE.iteritems():
+        f_cache = open(feed_cache_path(feedurl), 'wb')
+        cPickle.dump(cache + (state,), f_cache, cPickle.HIGHEST_PROTOCOL)
+        f_cache.flush()
+        f_cache.close()
+
+    # evict caches for feeds that have been removed
+    keep = set(md5(x).hexdigest() + '.cache' for x in ALL_FEEDS)
+    for fname in os.listdir(path):
+        rex = match(r'[0-9a-f]{32}\.cache$', fname)
+        if rex is None or fname in keep:
+            continue
+        if os.path.isfile(os.path.join(path, fname)):
+            os.remove(os.path.join(path, fname))
+
+    FEED_CACHE = dict()
 
 
 def filter_list(item):
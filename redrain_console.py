@@ -142,22 +142,29 @@ if __name__ == '__main__':
     # download queue
     QUEUE = list()
 
-    # show being scraped
+    # show being checked
     SHOWNUM = 1
 
-    # download and scan all feeds
-    for n in redrain.PODCASTS:
-        print 'scraping [' + str(SHOWNUM) + ']',
+    # download and parse all feeds
+    print 'scraping ' + str(len(redrain.PODCASTS)) + ' feeds ...'
+    FEEDS = redrain.scrape_feeds(redrain.PODCASTS)
+
+    # scan all feeds
+    for n, (error, count, episodes) in zip(redrain.PODCASTS, FEEDS):
+        print 'checking [' + str(SHOWNUM) + ']',
+
+        if error is not None:
+            print '[error: ' + error + ']',
 
         # if the show has a nice name defined, use it
         if 'nicename' in n:
             print n['nicename'],
-            feed = redrain.scrape_feed_url(n['feedurl'], n['nicename'])
+            feed = [redrain.episode_dict(x, n['nicename']) for x in episodes]
         else:
             print n['feedurl'],
-            feed = redrain.scrape_feed_url(n['feedurl'])
+            feed = [redrain.episode_dict(x) for x in episodes]
 
-        # filter out old episodes
+        # filter out old episodes; only new or changed ones are left to check
         tmp = [x for x in feed if redrain.filter_list(x) == True]
 
         # hack -- add the dl_file_name to each item in the feed
@@ -166,7 +173,7 @@ if __name__ == '__main__':
                 x['dl_file_name'] = n['dl_file_name']
 
         # status report for the user
-        print '[' + str(len(feed)) + '/' + str(len(tmp)) + ']'
+        print '[' + str(count) + '/' + str(len(tmp)) + ']'
 
         # enqueue the new episodes to be downloaded later
         QUEUE.extend(tmp)
@@ -198,3 +205,6 @@ if __name__ == '__main__':
 
     # save the urls/guids to file
     redrain.save_state()
+
+    # save the feed caches now that everything in them has been dealt with
+    redrain.save_feed_cache()